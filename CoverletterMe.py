@@ -3,30 +3,214 @@ CoverletterMe is an open source tool that writes coverletter for you using ChatG
 
 How to use: 
 Run python CoverletterMe.py in terminal/console
+Run python CoverletterMe.py --reuse to skip the dialogs when none of the
+cached inputs changed since the last run
+Run python CoverletterMe.py --batch-jobs jobs.jsonl to write a coverletter for 
+every job in jobs.jsonl through the OpenAI Batch API, at half the cost
+Run python CoverletterMe.py --batch-resume to collect the coverletters of a 
+batch if the run that submitted it stopped early
 
-If the window freezes after entering remarks, it's because ChatGPT is taking
-the time to generate your coverletter, please wait patiently.
+After entering remarks, a window opens and shows the coverletter while ChatGPT
+writes it. The coverletter is saved in your_new_cover_letter.txt, close the
+window to exit.
 """
 
+import argparse
+import asyncio
+import threading
 import openai
-from tkinter import messagebox
-from helperfunctions import get_completion, get_api_key, get_prompt
+from helperfunctions import (batch_build_letters, build_letter, clear_letter_hash, clear_pending_batch, close_client,
+                             collect_batch, get_api_key, get_batch_inputs, get_documents, get_input_hash,
+                             get_job_inputs, get_pending_batch, get_reused_prompt, get_root, is_letter_current,
+                             iterate_in_loop, prefetch_summaries, read_batch_jobs, save_letter_hash, show_progress,
+                             start_event_loop, stop_event_loop)
+
+LETTER_PATH = "your_new_cover_letter.txt"
+BATCH_ERRORS_PATH = "batch_errors.txt"
+
+
+def write_cover_letter(loop, letter, on_delta, on_wait=None):
+    """
+    Writes the coverletter to LETTER_PATH as ChatGPT generates it
+
+    Input:
+    loop - background event loop the requests run on
+    letter - async generator yielding pieces of the coverletter
+    on_delta - function called with every new piece of the coverletter
+    on_wait - optional function called repeatedly while waiting for ChatGPT
+    """
+
+    with open(LETTER_PATH, "w", buffering=1) as f:
+        for delta in iterate_in_loop(loop, letter, on_wait=on_wait):
+            f.write(delta)
+            on_delta(delta)
+
+
+async def close_after(coroutine):
+    """
+    Runs a coroutine, then closes the shared OpenAI client
+
+    Input:
+    coroutine - coroutine sending OpenAI requests
+
+    Output:
+    result - what coroutine returned
+    """
+
+    try:
+        return await coroutine
+    finally:
+        # Close connections while the event loop is still running
+        await close_client()
+
+
+def save_batch_cover_letters(batch, letters, errors):
+    """
+    Writes the coverletters of a finished batch to your_new_cover_letter_<id>.txt
+    and reports the jobs that failed
+
+    Input:
+    batch - the finished batch
+    letters - dictionary mapping a job id to its coverletter
+    errors - why the batch or single jobs failed, formatted as strings
+    """
+
+    from tkinter import messagebox
+
+    for job_id, letter in letters.items():
+        with open(f"your_new_cover_letter_{job_id}.txt", "w") as f:
+            f.write(letter)
+
+    if get_pending_batch() == batch.id:
+        clear_pending_batch()
+
+    total = batch.request_counts.total if batch.request_counts is not None else len(letters)
+    message = (f"Batch {batch.id} {batch.status}: {len(letters)} of {total} new cover letters "
+               "successfully saved in your_new_cover_letter_<id>.txt")
+
+    if not errors and batch.status == "completed":
+        messagebox.showinfo("CoverletterMe", message, parent=get_root())
+        return
+
+    if errors:
+        with open(BATCH_ERRORS_PATH, "w") as f:
+            f.write("\n".join(errors) + "\n")
+        message += f"\n\n{len(errors)} error(s), all of them are saved in {BATCH_ERRORS_PATH}:\n" + "\n".join(errors[:5])
+
+    messagebox.showwarning("CoverletterMe", message, parent=get_root())
+
+
+def report_batch(batch_id):
+    """
+    Tells the user how to collect the coverletters if the run stops early
+
+    Input:
+    batch_id - id of the submitted batch
+    """
+
+    print(f"Submitted batch {batch_id}. If CoverletterMe stops before it is done, "
+          "run python CoverletterMe.py --batch-resume to collect the cover letters.")
+
+
+def write_batch_cover_letters(jobs_path):
+    """
+    Writes a coverletter for every job in jobs_path to your_new_cover_letter_<id>.txt
+
+    Input:
+    jobs_path - path of a .jsonl file, each line holding a job with an "id", 
+                a "description" and optionally its own "remarks"
+    """
+
+    jobs = read_batch_jobs(jobs_path)
+    if jobs is None:
+        return
+
+    inputs = get_batch_inputs()
+    save_batch_cover_letters(*asyncio.run(close_after(batch_build_letters(jobs, *inputs, on_submit=report_batch))))
+
+
+def resume_batch_cover_letters(batch_id):
+    """
+    Collects the coverletters of a batch submitted by an earlier run
+
+    Input:
+    batch_id - id of the batch, or None for the batch the last run submitted
+    """
+
+    from tkinter import messagebox
+
+    batch_id = batch_id or get_pending_batch()
+    if batch_id is None:
+        messagebox.showwarning("CoverletterMe", "No submitted batch to resume.", parent=get_root())
+        return
+
+    save_batch_cover_letters(*asyncio.run(close_after(collect_batch(batch_id))))
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Writes coverletter for you using ChatGPT")
+    parser.add_argument("--reuse", action="store_true",
+                        help="skip the dialogs and reuse the last prompt if no cached input changed")
+    parser.add_argument("--batch-jobs", metavar="JOBS_FILE",
+                        help="write a coverletter for every job in a .jsonl file through the OpenAI Batch API")
+    parser.add_argument("--batch-resume", metavar="BATCH_ID", nargs="?", const="",
+                        help="collect the coverletters of a submitted batch, by default the last one")
+    args = parser.parse_args()
+
     # Connect to OpenAI using user API
     openai.api_key = get_api_key()
 
-    # Get response using prompt
-    prompt = get_prompt()
-    response = get_completion(prompt)
+    if args.batch_jobs is not None:
+        write_batch_cover_letters(args.batch_jobs)
+        return
+
+    if args.batch_resume is not None:
+        resume_batch_cover_letters(args.batch_resume or None)
+        return
+
+    loop = start_event_loop()
+    try:
+        # Get user input unless the last prompt can be reused
+        prompt = get_reused_prompt() if args.reuse else None
+        inputs = prefetch = input_hash = None
+        if prompt is None:
+            resume, reference_coverletter = get_documents()
+            # Summarize the documents while the user enters the job description
+            prefetch = prefetch_summaries(loop, resume, reference_coverletter)
+            description, remarks = get_job_inputs()
+            inputs = (resume, reference_coverletter, description, remarks)
+
+            # Skip ChatGPT if the last coverletter was written from the same input
+            input_hash = get_input_hash(inputs)
+            if is_letter_current(LETTER_PATH, input_hash):
+                # The prefetched summaries aren't needed, don't let the request finish
+                prefetch.cancel()
+                from tkinter import messagebox
+                messagebox.showinfo("CoverletterMe", 
+                                    f"Nothing changed since the last run, your cover letter is in {LETTER_PATH}",
+                                    parent=get_root())
+                return
+
+        # Show the response while it is being generated
+        window, append = show_progress("CoverletterMe")
 
-    # Save response in text file
-    with open("your_new_cover_letter.txt", "w") as f:
-        f.write(response)
+        # Save response in text file as it arrives
+        clear_letter_hash(LETTER_PATH)
+        finished = threading.Event()
+        # Keep processing Tk events while waiting, so the window can redraw and be closed
+        write_cover_letter(loop, build_letter(inputs, prompt=prompt, prefetch=prefetch, on_finish=finished.set),
+                           append, on_wait=window.update)
+        # A cut off coverletter is written again on the next run
+        if input_hash is not None and finished.is_set():
+            save_letter_hash(LETTER_PATH, input_hash)
+    finally:
+        stop_event_loop(loop)
 
-    messagebox.showinfo("CoverletterMe", "New cover letter successfully saved in your_new_cover_letter.txt")
+    # Closing the window during generation means the user is done with it
+    if window.state() != "withdrawn":
+        window.title(f"CoverletterMe - new cover letter successfully saved in {LETTER_PATH}")
+        window.mainloop()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
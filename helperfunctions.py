@@ -2,31 +2,1077 @@
 Helper functions that handle user input for CoverletterMe
 """
 
-import openai
-import tkinter as tk
-from tkinter import filedialog, messagebox
-import docx
-import pickle
+import os
+import re
+import json
+import asyncio
+import hashlib
+import tempfile
+import threading
+import concurrent.futures
+import zipfile
+import xml.etree.ElementTree as ET
+import orjson
+import zstandard as zstd
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 
 
-def get_completion(prompt, model="gpt-3.5-turbo"):
+RESPONSE_CACHE_DIR = "response_cache"
+RESPONSE_CACHE_SIZE = 100 # number of responses kept on disk
+REQUEST_TIMEOUT = 60 # seconds before a stalled OpenAI request is given up
+LETTER_FIELD = "cl" # JSON key the coverletter is returned in, short to save tokens
+
+# Every summary prompt and its 200 token summary have to fit in the 4096 token
+# context of gpt-3.5-turbo-instruct, so each summarized input is capped
+SUMMARY_INPUT_CHARS = 10000 # characters of a resume or job description, at most about 3300 tokens
+
+# Summaries are requested in chunks, which keeps single requests small. The 
+# context limit above applies to each prompt on its own, not to a chunk
+SUMMARY_CHUNK_PROMPTS = 16 # prompts per completion request
+SUMMARY_CHUNK_CHARS = 24000 # characters per completion request
+
+# Id of the last submitted batch, kept until its coverletters are saved
+PENDING_BATCH = "pending_batch.txt"
+
+# Last composed prompt, reused while the cached inputs below are unchanged
+PROMPT_CACHE = "prompt.pkl"
+INPUT_NAMES = ("Resume", "Cover letter", "Job description", "Additional prompt")
+
+# XML namespace of the main part of a .docx file
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# Prompt templates, filled in with str.format
+DESCRIPTION_PROMPT = """
+Summarize the requirements for the following job \
+description delimited by triple backticks.
+Job description: ```{description}```
+"""
+
+RESUME_PROMPT = """
+Extract skills and experience from the resume delimited by \
+triple backticks that are relevant to a job application.
+Resume: ```{resume}```
+"""
+
+REFERENCE_PROMPT = """
+Summarize the tone and format of the following \
+coverletter deliminated by triple backticks.
+Reference coverletter: ```{reference_coverletter}```
+"""
+
+COVERLETTER_PROMPT = """
+Write a coverletter for the job requirements delimited by triple \
+backticks, using the skills and experience that are relevant to the \
+job. Use a professional and conversational tone and match the tone \
+and format of the reference coverletter.
+
+The coverletter is intended for hiring manager, so it should focus on \
+matching qualifications to the job requirements provided. 
+
+Qualification should be presented using the "show, don't tell" technique. 
+
+Try to establish a relationship between my experiences and the job. 
+
+Keep in mind that {remarks}.
+
+Job requirements: ```{description_summary}```
+
+Skills and experience: ```{resume_summary}```
+
+Reference coverletter: ```{reference_summary}```
+"""
+
+# Hidden Tk root shared by every dialog, created on first use
+_ROOT = None
+
+# OpenAI client shared by every request, created on first use
+_CLIENT = None
+
+
+def get_root():
+    """
+    Returns the hidden Tk root that parents every window of CoverletterMe
+
+    Output:
+    root - the hidden Tk root
+    """
+
+    global _ROOT
+    import tkinter as tk
+
+    if _ROOT is None:
+        _ROOT = tk.Tk()
+        _ROOT.withdraw()
+
+    return _ROOT
+
+
+def get_client():
+    """
+    Returns the OpenAI client shared by every request. It keeps its 
+    connections alive and multiplexes concurrent requests over HTTP/2
+
+    Output:
+    client - the shared OpenAI client
+    """
+
+    global _CLIENT
+    import httpx
+    import openai
+
+    if _CLIENT is None:
+        _CLIENT = openai.AsyncOpenAI(
+            api_key=openai.api_key,
+            max_retries=0, # every request goes through a retry_transient wrapper
+            http_client=httpx.AsyncClient(http2=True, limits=httpx.Limits(max_keepalive_connections=8)),
+        )
+
+    return _CLIENT
+
+
+def is_transient_error(error):
+    """
+    Checks if an OpenAI request failed for a reason that may go away on retry
+
+    Input:
+    error - exception raised by the request
+
+    Output:
+    True for rate limits, timeouts, connection and server errors
+    """
+
+    import openai
+
+    return isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+
+
+# Retries failed OpenAI requests with exponential backoff and jitter
+retry_transient = retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception(is_transient_error),
+    reraise=True,
+)
+
+
+@retry_transient
+async def create_completion(client, **request):
+    """
+    Sends a completion request, retrying transient failures
+
+    Input:
+    client - OpenAI client used to send the request
+    request - arguments of the completion request
+
+    Output:
+    response - the completion
+    """
+
+    return await client.completions.create(**request, timeout=REQUEST_TIMEOUT)
+
+
+@retry_transient
+async def create_chat_completion(client, **request):
+    """
+    Sends a chat completion request, retrying transient failures. For a 
+    streamed request only opening the stream is retried
+
+    Input:
+    client - OpenAI client used to send the request
+    request - arguments of the chat completion request
+
+    Output:
+    response - the chat completion, or a stream of chunks if stream=True
+    """
+
+    return await client.chat.completions.create(**request, timeout=REQUEST_TIMEOUT)
+
+
+@retry_transient
+async def upload_batch_file(client, data):
+    """
+    Uploads the requests of a batch, retrying transient failures
+
+    Input:
+    client - OpenAI client used to send the request
+    data - content of the .jsonl batch file, formatted as bytes
+
+    Output:
+    batch_file - the uploaded file
+    """
+
+    return await client.files.create(file=("batch_jobs.jsonl", data), purpose="batch", timeout=REQUEST_TIMEOUT)
+
+
+@retry_transient
+async def create_batch(client, **request):
+    """
+    Creates a batch, retrying transient failures
+
+    Input:
+    client - OpenAI client used to send the request
+    request - arguments of the batch request
+
+    Output:
+    batch - the submitted batch
+    """
+
+    return await client.batches.create(**request, timeout=REQUEST_TIMEOUT)
+
+
+@retry_transient
+async def retrieve_batch(client, batch_id):
+    """
+    Gets the current state of a batch, retrying transient failures
+
+    Input:
+    client - OpenAI client used to send the request
+    batch_id - id of the submitted batch
+
+    Output:
+    batch - the batch
+    """
+
+    return await client.batches.retrieve(batch_id, timeout=REQUEST_TIMEOUT)
+
+
+@retry_transient
+async def download_file(client, file_id):
+    """
+    Downloads the content of a file, retrying transient failures
+
+    Input:
+    client - OpenAI client used to send the request
+    file_id - id of the file
+
+    Output:
+    content - the file content, its text is in content.text
+    """
+
+    return await client.files.content(file_id, timeout=REQUEST_TIMEOUT)
+
+
+async def close_client():
+    """
+    Closes the connections of the shared OpenAI client, call it before the 
+    event loop that used the client is closed
+    """
+
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.close()
+        _CLIENT = None
+
+
+async def batch_summarize(client, prompts, model="gpt-3.5-turbo-instruct"):
+    """
+    Function that gets short summaries for several prompts from as few
+    requests as the token limits allow, cache the results
+
+    Input:
+    client - OpenAI client used to send the request
+    prompts - prompts for the completion model
+    model - completion model to use, it has to accept a list of prompts
+
+    Output:
+    summaries - output for each prompt, in the same order as prompts
+    """
+    temperature = 0 # this is the degree of randomness of the model's output
+    max_tokens = 200 # summaries only need a few sentences
+
+    # Repeated prompts are only sent once
+    summaries = {prompt: get_cached_response(prompt, model, temperature, max_tokens) for prompt in prompts}
+    missing = [prompt for prompt, summary in summaries.items() if summary is None]
+
+    # Each chunk is cached as soon as it arrives, so a failed run resumes 
+    # where it stopped
+    for chunk in chunk_prompts(missing):
+        response = await create_completion(
+            client,
+            model=model,
+            prompt=chunk,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+
+        # Choices are not guaranteed to come back in order, match them by index
+        for choice in response.choices:
+            prompt = chunk[choice.index]
+            summaries[prompt] = choice.text.strip()
+            cache_response(prompt, model, temperature, max_tokens, summaries[prompt])
+
+    return [summaries[prompt] for prompt in prompts]
+
+
+def chunk_prompts(prompts, max_prompts=SUMMARY_CHUNK_PROMPTS, max_chars=SUMMARY_CHUNK_CHARS):
+    """
+    Splits prompts into chunks small enough to be sent in one request
+
+    Input:
+    prompts - prompts for the completion model
+    max_prompts - most prompts in a chunk
+    max_chars - most characters in a chunk, a longer prompt gets a chunk 
+                of its own
+
+    Output:
+    yields lists of prompts, in the same order as prompts
+    """
+
+    chunk, size = [], 0
+    for prompt in prompts:
+        if chunk and (len(chunk) == max_prompts or size + len(prompt) > max_chars):
+            yield chunk
+            chunk, size = [], 0
+
+        chunk.append(prompt)
+        size += len(prompt)
+
+    if chunk:
+        yield chunk
+
+
+async def get_completion(client, prompt, model="gpt-3.5-turbo", on_finish=None):
+    """
+    Function that streams response from ChatGPT 3.5, cache the result
+
+    Input:
+    client - OpenAI client used to send the request
+    prompt - prompt for ChatGPT
+    model - ChatGPT version to use
+    on_finish - optional function called once the whole response arrived, 
+                it isn't called if the response was cut off by max_tokens
+
+    Output:
+    yields pieces of the response from ChatGPT as they arrive
+    """
+    request = get_compose_request(prompt, model)
+    cache_key = (prompt, model, request["temperature"], request["max_tokens"])
+
+    cached = get_cached_response(*cache_key)
+    if cached is not None:
+        yield cached
+        if on_finish is not None:
+            on_finish()
+        return
+
+    response = await create_chat_completion(
+        client,
+        **request,
+        stream=True, # receive the response piece by piece as it is generated
+    )
+
+    parts = []
+    finish_reason = None
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        parts.append(delta)
+        yield delta
+
+    # A response cut off by max_tokens would be replayed from the cache forever
+    if finish_reason == "stop":
+        cache_response(*cache_key, "".join(parts))
+        if on_finish is not None:
+            on_finish()
+
+
+def get_compose_request(prompt, model="gpt-3.5-turbo"):
+    """
+    Settings of the ChatGPT request that writes the coverletter
+
+    Input:
+    prompt - prompt for ChatGPT
+    model - ChatGPT version to use
+
+    Output:
+    request - arguments of the chat completion request
+    """
+
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": f"Return a JSON object with one key \"{LETTER_FIELD}\" whose value is the coverletter."},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0, # this is the degree of randomness of the model's output
+        "max_tokens": 800, # about the length of a cover letter
+        "response_format": {"type": "json_object"}, # only the coverletter, no other text
+    }
+
+
+def split_json_string(raw):
+    """
+    Finds how much of a partially received JSON string can be decoded
+
+    Input:
+    raw - text following the opening quote of a JSON string
+
+    Output:
+    end - length of the start of raw that holds only complete characters
+    closed - True if the closing quote of the string follows right after
+    """
+
+    i = 0
+    while i < len(raw):
+        if raw[i] == '"':
+            return i, True
+        if raw[i] != "\\":
+            i += 1
+        elif i + 1 < len(raw) and raw[i + 1] != "u":
+            i += 2
+        elif i + 6 <= len(raw) and not 0xD800 <= int(raw[i + 2:i + 6], 16) <= 0xDBFF:
+            i += 6
+        elif i + 12 <= len(raw):
+            # A high surrogate is decoded together with the low surrogate after it
+            i += 12
+        else:
+            break
+
+    return i, False
+
+
+async def stream_json_field(deltas, key):
+    """
+    Decodes one string field of a JSON object while the object is streamed
+
+    Input:
+    deltas - async iterable of pieces of the JSON object
+    key - name of the string field
+
+    Output:
+    yields pieces of the decoded field as they arrive. Text that isn't a JSON
+    object, like responses cached by older versions, is passed through as is
+    """
+
+    key_pattern = re.compile(r'"%s"\s*:\s*"' % re.escape(key))
+    raw = ""
+    state = "start"
+
+    async for delta in deltas:
+        if state == "plain":
+            yield delta
+            continue
+        if state == "done":
+            continue
+
+        raw += delta
+        if state == "start":
+            if not raw.strip():
+                continue
+            if not raw.lstrip().startswith("{"):
+                state = "plain"
+                yield raw
+                continue
+            state = "key"
+
+        if state == "key":
+            match = key_pattern.search(raw)
+            if match is None:
+                continue
+            raw = raw[match.end():]
+            state = "value"
+
+        end, closed = split_json_string(raw)
+        if end:
+            yield json.loads(f'"{raw[:end]}"', strict=False)
+            raw = raw[end:]
+        if closed:
+            state = "done"
+
+    if state in ("start", "key"):
+        # The field never showed up, don't lose the response
+        yield raw
+
+
+async def batch_submit(client, prompts):
+    """
+    Submits coverletter prompts to the OpenAI Batch API, which costs half 
+    as much but may take up to 24 hours to finish
+
+    Input:
+    client - OpenAI client used to send the request
+    prompts - dictionary mapping an id to the prompt for ChatGPT
+
+    Output:
+    batch_id - id of the submitted batch
+    """
+
+    lines = [
+        orjson.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": get_compose_request(prompt),
+        })
+        for custom_id, prompt in prompts.items()
+    ]
+    batch_file = await upload_batch_file(client, b"\n".join(lines))
+
+    batch = await create_batch(
+        client,
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+async def wait_for_batch(client, batch_id, delay=5, max_delay=600):
+    """
+    Polls a batch with exponential backoff until it stops running
+
+    Input:
+    client - OpenAI client used to send the request
+    batch_id - id of the submitted batch
+    delay - seconds to wait before the first poll
+    max_delay - longest wait between two polls, in seconds
+
+    Output:
+    batch - the finished batch
+    """
+
+    while True:
+        batch = await retrieve_batch(client, batch_id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            return batch
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+async def get_batch_results(client, batch):
+    """
+    Downloads the coverletters written by a finished batch
+
+    Input:
+    client - OpenAI client used to send the request
+    batch - the finished batch
+
+    Output:
+    letters - dictionary mapping an id to its coverletter
+    errors - why the batch or single requests failed, formatted as strings
+    """
+
+    letters = {}
+    errors = []
+
+    # Problems with the batch file itself, e.g. a request that failed validation
+    if batch.errors is not None:
+        for error in batch.errors.data or []:
+            errors.append(f"line {error.line}: {error.message}" if error.line else error.message)
+
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id is None:
+            continue
+
+        output = await download_file(client, file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+
+            result = orjson.loads(line)
+            custom_id = result["custom_id"]
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                error = result.get("error") or (response.get("body") or {}).get("error") or {}
+                errors.append(f"{custom_id}: {error.get('message', 'request failed')}")
+                continue
+
+            content = response["body"]["choices"][0]["message"]["content"]
+            try:
+                letters[custom_id] = orjson.loads(content)[LETTER_FIELD]
+            except (orjson.JSONDecodeError, KeyError, TypeError):
+                errors.append(f"{custom_id}: the response doesn't hold a coverletter")
+
+    return letters, errors
+
+
+def save_pending_batch(batch_id):
+    """
+    Remembers a submitted batch, so its coverletters can still be collected 
+    with --batch-resume if CoverletterMe stops before the batch is done
+
+    Input:
+    batch_id - id of the submitted batch
+    """
+
+    write_atomic(PENDING_BATCH, batch_id.encode())
+
+
+def get_pending_batch():
+    """
+    Retrieves the batch saved by save_pending_batch
+
+    Output:
+    batch_id - id of the submitted batch, or None if there is no pending batch
+    """
+
+    try:
+        with open(PENDING_BATCH) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def clear_pending_batch():
+    """
+    Forgets the pending batch once its coverletters are saved
+    """
+
+    try:
+        os.remove(PENDING_BATCH)
+    except FileNotFoundError:
+        pass
+
+
+def write_atomic(path, data):
+    """
+    Writes a file so that an interrupted write never leaves a truncated file 
+    behind: the data goes to a temporary file that then replaces path
+
+    Input:
+    path - path of the file
+    data - content of the file, formatted as bytes
+    """
+
+    directory = os.path.dirname(path) or "."
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as f:
+        f.write(data)
+
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.remove(f.name)
+        raise
+
+
+def get_response_cache_path(prompt, model, temperature, max_tokens):
+    """
+    Locates the cached ChatGPT response for a request
+
+    Input:
+    prompt, model, temperature, max_tokens - settings of the ChatGPT request
+
+    Output:
+    path - path of the pickle holding the response
+    """
+
+    key = hashlib.sha256(f"{model}\0{temperature}\0{max_tokens}\0{prompt}".encode()).hexdigest()
+    return os.path.join(RESPONSE_CACHE_DIR, f"{key}.pkl")
+
+
+def get_cached_response(prompt, model, temperature, max_tokens):
+    """
+    Retrieves cached ChatGPT response stored in a pickle
+
+    Input:
+    prompt, model, temperature, max_tokens - settings of the ChatGPT request
+
+    Output:
+    response - output from ChatGPT, or None if the request wasn't cached
+    """
+
+    import pickle
+
+    path = get_response_cache_path(prompt, model, temperature, max_tokens)
+    try:
+        with open(path, "rb") as f:
+            response = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (EOFError, pickle.UnpicklingError):
+        # Left behind by an older interrupted write, treat it as a miss
+        os.remove(path)
+        return None
+
+    # Mark the response as recently used so it is evicted last
+    os.utime(path)
+    return response
+
+
+def cache_response(prompt, model, temperature, max_tokens, response):
+    """
+    Caches ChatGPT response using pickle, evicting the least recently used
+    responses once there are more than RESPONSE_CACHE_SIZE
+
+    Input:
+    prompt, model, temperature, max_tokens - settings of the ChatGPT request
+    response - output from ChatGPT
+    """
+
+    import pickle
+
+    os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+    write_atomic(get_response_cache_path(prompt, model, temperature, max_tokens),
+                 pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL))
+
+    entries = [entry for entry in os.scandir(RESPONSE_CACHE_DIR) if entry.name.endswith(".pkl")]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries[:-RESPONSE_CACHE_SIZE]:
+        os.remove(entry.path)
+
+
+async def build_letter(inputs, prompt=None, prefetch=None, client=None, on_finish=None):
+    """
+    Summarizes the inputs in a single request, then streams the coverletter
+
+    Input:
+    inputs - resume, reference coverletter, job description and remarks, 
+             formatted as strings
+    prompt - prompt reused from the last run, if given the inputs are not 
+             summarized again
+    prefetch - future returned by prefetch_summaries for these inputs
+    client - OpenAI client used to send the requests, defaults to the 
+             shared client
+    on_finish - optional function called once the whole coverletter arrived,
+                it isn't called if the coverletter was cut off
+
+    Output:
+    yields pieces of the coverletter as they arrive
+    """
+
+    client = client or get_client()
+
+    if prompt is None:
+        resume, reference_coverletter, description, remarks = inputs
+        if prefetch is not None:
+            # Once the prefetched summaries are cached only the job 
+            # description is left to summarize
+            await asyncio.wrap_future(prefetch)
+
+        summaries = await batch_summarize(
+            client, get_summary_prompts(resume, reference_coverletter, description)
+        )
+
+        # The compose prompt only holds the short summaries
+        prompt = get_prompt(*summaries, remarks)
+        cache_prompt(prompt)
+
+    async for delta in stream_json_field(get_completion(client, prompt, on_finish=on_finish), LETTER_FIELD):
+        yield delta
+
+
+async def batch_build_letters(jobs, resume, reference_coverletter, remarks, client=None, on_submit=None):
+    """
+    Writes a coverletter for every job through the OpenAI Batch API
+
+    Input:
+    jobs - list of jobs, each a dictionary with an "id", a "description" 
+           and optionally its own "remarks"
+    resume - content in the resume file, formatted as string
+    reference_coverletter - content in the coverletter file, formatted as string
+    remarks - additional prompt used for jobs without their own remarks
+    client - OpenAI client used to send the requests, defaults to the 
+             shared client
+    on_submit - optional function called with the batch id once the batch 
+                is submitted, before waiting for it to finish
+
+    Output:
+    batch - the finished batch
+    letters - dictionary mapping a job id to its coverletter
+    errors - why the batch or single jobs failed, formatted as strings
+    """
+
+    client = client or get_client()
+
+    # Summarize the job descriptions in as few requests as the token limits 
+    # allow, the resume and reference coverletter prompts are only sent once
+    summary_prompts = [
+        prompt
+        for job in jobs
+        for prompt in get_summary_prompts(resume, reference_coverletter, clean_text(job["description"]))
+    ]
+    summaries = await batch_summarize(client, summary_prompts)
+
+    prompts = {}
+    for i, job in enumerate(jobs):
+        description_summary, resume_summary, reference_summary = summaries[3 * i:3 * i + 3]
+        prompts[str(job["id"])] = get_prompt(description_summary, resume_summary, reference_summary,
+                                             clean_text(job.get("remarks", remarks)))
+
+    batch_id = await batch_submit(client, prompts)
+    save_pending_batch(batch_id)
+    if on_submit is not None:
+        on_submit(batch_id)
+
+    return await collect_batch(batch_id, client=client)
+
+
+async def collect_batch(batch_id, client=None):
+    """
+    Waits for a submitted batch to finish and downloads its coverletters
+
+    Input:
+    batch_id - id of the submitted batch
+    client - OpenAI client used to send the requests, defaults to the 
+             shared client
+
+    Output:
+    batch - the finished batch
+    letters - dictionary mapping a job id to its coverletter
+    errors - why the batch or single jobs failed, formatted as strings
+    """
+
+    client = client or get_client()
+
+    batch = await wait_for_batch(client, batch_id)
+    letters, errors = await get_batch_results(client, batch)
+
+    return batch, letters, errors
+
+
+def start_event_loop():
+    """
+    Starts an asyncio event loop in a background thread, so OpenAI requests 
+    keep running while Tk dialogs block the main thread. Tk itself has to 
+    stay on the main thread
+
+    Output:
+    loop - the running event loop
+    """
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    return loop
+
+
+def stop_event_loop(loop):
     """
-    Function that gets response from ChatGPT 3.5 
+    Cancels the requests still running, closes the shared OpenAI client and 
+    stops an event loop started by start_event_loop
 
     Input:
-    prompt - prompt for ChatGPT
-    model - ChatGPT version to use
+    loop - the running event loop
+    """
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+async def shutdown():
+    """
+    Cancels every other task on the running event loop, waits for them to 
+    finish, then closes the shared OpenAI client
+    """
+
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    await close_client()
+
+
+def iterate_in_loop(loop, generator, on_wait=None):
+    """
+    Iterates an async generator on the background event loop
+
+    Input:
+    loop - the running event loop
+    generator - async generator to run on loop
+    on_wait - optional function called repeatedly while waiting for the next 
+              item, e.g. to keep a Tk window responsive
 
     Output:
-    response - output from ChatGPT
+    yields the items of generator in the calling thread
     """
-    messages = [{"role": "user", "content": prompt}]
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-        temperature=0, # this is the degree of randomness of the model's output
+
+    while True:
+        future = asyncio.run_coroutine_threadsafe(generator.__anext__(), loop)
+        if on_wait is not None:
+            while not future.done():
+                on_wait()
+                concurrent.futures.wait([future], timeout=0.05)
+
+        try:
+            yield future.result()
+        except StopAsyncIteration:
+            return
+
+
+def prefetch_summaries(loop, resume, reference_coverletter):
+    """
+    Starts summarizing the resume and reference coverletter on the background
+    event loop, while the user is still entering the job description
+
+    Input:
+    loop - the running event loop
+    resume - content in the resume file, formatted as string
+    reference_coverletter - content in the coverletter file, formatted as string
+
+    Output:
+    prefetch - future that is done once both summaries are cached
+    """
+
+    return asyncio.run_coroutine_threadsafe(
+        batch_summarize(get_client(), get_document_prompts(resume, reference_coverletter)), loop
     )
-    return response.choices[0].message["content"]
+
+
+def get_input_mtimes():
+    """
+    Gets the modification times of the cached inputs
+
+    Output:
+    mtimes - modification time of each cached input, 
+             or None if one of them doesn't exist
+    """
+
+    try:
+        return [os.path.getmtime(get_cache_path(name)) for name in INPUT_NAMES]
+    except FileNotFoundError:
+        return None
+
+
+def cache_prompt(prompt):
+    """
+    Caches the composed prompt along with the state of the cached inputs
+
+    Input:
+    prompt - prompt used to get ChatGPT generated coverletter
+    """
+
+    import pickle
+
+    write_atomic(PROMPT_CACHE,
+                 pickle.dumps({"prompt": prompt, "mtimes": get_input_mtimes()}, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def get_reused_prompt():
+    """
+    Retrieves the prompt composed in the last run
+
+    Output:
+    prompt - prompt used to get ChatGPT generated coverletter, or None if 
+             there is no cached prompt or any cached input changed since
+    """
+
+    import pickle
+
+    try:
+        with open(PROMPT_CACHE, "rb") as f:
+            cached = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+    mtimes = get_input_mtimes()
+    if mtimes is None or mtimes != cached["mtimes"]:
+        return None
+
+    return cached["prompt"]
+
+
+def get_input_hash(inputs):
+    """
+    Hashes the user input a coverletter is written from
+
+    Input:
+    inputs - resume, reference coverletter, job description and remarks, 
+             formatted as strings
+
+    Output:
+    input_hash - hex digest of the inputs
+    """
+
+    joined = "\0".join(text or "" for text in inputs)
+    return hashlib.blake2b(joined.encode(), digest_size=16).hexdigest()
+
+
+def is_letter_current(letter_path, input_hash):
+    """
+    Checks if a coverletter was written from the same user input
+
+    Input:
+    letter_path - path of the coverletter
+    input_hash - hash of the user input, from get_input_hash
+
+    Output:
+    True if the coverletter exists and its stored hash matches input_hash
+    """
+
+    try:
+        with open(f"{letter_path}.sha") as f:
+            return f.read().strip() == input_hash and os.path.exists(letter_path)
+    except FileNotFoundError:
+        return False
+
+
+def save_letter_hash(letter_path, input_hash):
+    """
+    Stores the hash of the user input next to the coverletter written from it
+
+    Input:
+    letter_path - path of the coverletter
+    input_hash - hash of the user input, from get_input_hash
+    """
+
+    with open(f"{letter_path}.sha", "w") as f:
+        f.write(input_hash)
+
+
+def clear_letter_hash(letter_path):
+    """
+    Removes the stored hash of a coverletter that is about to be rewritten, so
+    an interrupted run isn't mistaken for a finished one
+
+    Input:
+    letter_path - path of the coverletter
+    """
+
+    try:
+        os.remove(f"{letter_path}.sha")
+    except FileNotFoundError:
+        pass
+
+
+def show_progress(title):
+    """
+    Opens a window that displays the response while it is being generated
+
+    Input:
+    title - title of the window
+
+    Output:
+    window - the window displaying the response
+    append - function that adds a piece of text to the window
+    """
+
+    import tkinter as tk
+
+    window = tk.Toplevel(get_root())
+    window.title(title)
+    text = tk.Text(window, wrap="word")
+    text.pack(fill="both", expand=True)
+    text.insert(tk.END, "Summarizing your input, the coverletter will appear here...")
+    started = False
+
+    def close():
+        # The window is only hidden, generation keeps going and the 
+        # coverletter is still saved. quit only ends an already running mainloop
+        window.withdraw()
+        get_root().quit()
+
+    window.protocol("WM_DELETE_WINDOW", close)
+
+    def append(delta):
+        nonlocal started
+        if not started:
+            # Replace the status text with the coverletter
+            text.delete("1.0", tk.END)
+            started = True
+
+        text.insert(tk.END, delta)
+        text.see(tk.END)
+        # Redraw the window now, the generation loop doesn't return to Tk
+        window.update()
+
+    # Draw the window before the first piece of the coverletter arrives
+    window.update()
+
+    return window, append
 
 
 def get_api_key():
@@ -37,16 +1083,15 @@ def get_api_key():
     key - ChatGPT API key formatted in string
     """
 
+    from tkinter import simpledialog
+
     api_key = get_cached_file("API_key")
     
     if api_key is None:
-        root = tk.Tk()
-        root.withdraw()
-        api_key = tk.simpledialog.askstring("API key", 
-                                            "Enter your OpenAI API key. If you don't have it, please go to https://platform.openai.com/account/api-keys")
-        # Cache the docx_string using pickle
-        with open("API_key.pkl", "wb") as f:
-            pickle.dump(api_key, f)
+        api_key = simpledialog.askstring("API key", 
+                                         "Enter your OpenAI API key. If you don't have it, please go to https://platform.openai.com/account/api-keys",
+                                         parent=get_root())
+        cache_file("API_key", api_key)
     
     return api_key
 
@@ -62,28 +1107,72 @@ def select_docx_file(filename):
     docx_string - content in the .docx file, formatted as a string
     """
 
-    messagebox.showinfo(filename, f"Please select your current {filename}")
+    from tkinter import filedialog, messagebox
 
-    root = tk.Tk()
-    root.withdraw()
-    file_path = filedialog.askopenfilename(filetypes=[("Word Document", "*.docx")])
+    messagebox.showinfo(filename, f"Please select your current {filename}", parent=get_root())
+
+    file_path = filedialog.askopenfilename(filetypes=[("Word Document", "*.docx")], parent=get_root())
 
     if file_path:
-        # Read the input text as a string using the docx package
-        doc = docx.Document(file_path)
-        paragraphs = [p.text for p in doc.paragraphs]
-        docx_string = "\n".join(paragraphs)
-
-        # Cache the input text string using pickle
-        with open(f"""{filename.replace(" ", "_")}.pkl""", "wb") as f:
-            pickle.dump(docx_string, f)
+        docx_string = fast_docx_text(file_path)
+
+        cache_file(filename, docx_string)
     else:
-        messagebox.showwarning(filename, f"No file selected. No {filename} cached.")
+        messagebox.showwarning(filename, f"No file selected. No {filename} cached.", parent=get_root())
         docx_string = get_cached_file(filename)
     
     return docx_string
 
 
+def fast_docx_text(file_path):
+    """
+    Reads the text of a .docx file straight from its XML, without building
+    the full document model
+
+    Input:
+    file_path - path of the .docx file
+
+    Output:
+    docx_string - non-empty paragraphs of the .docx file, separated by newlines
+    """
+
+    with zipfile.ZipFile(file_path) as z:
+        with z.open("word/document.xml") as xml:
+            paragraphs = []
+            for _, element in ET.iterparse(xml):
+                if element.tag == WORD_NAMESPACE + "p":
+                    text = "".join(get_run_text(run) for run in element.iter(WORD_NAMESPACE + "r"))
+                    if text.strip():
+                        paragraphs.append(text)
+                    element.clear()
+
+    return "\n".join(paragraphs)
+
+
+def get_run_text(run):
+    """
+    Gets the text of a run in a .docx paragraph the way python-docx does, 
+    tabs and line breaks included
+
+    Input:
+    run - <w:r> element of the paragraph
+
+    Output:
+    text - content of the run, formatted as a string
+    """
+
+    pieces = []
+    for child in run:
+        if child.tag == WORD_NAMESPACE + "t":
+            pieces.append(child.text or "")
+        elif child.tag == WORD_NAMESPACE + "tab":
+            pieces.append("\t")
+        elif child.tag in (WORD_NAMESPACE + "br", WORD_NAMESPACE + "cr"):
+            pieces.append("\n")
+
+    return "".join(pieces)
+
+
 def enter_docx_file(filename):
     """
     Prompts user to manually enter some text
@@ -95,24 +1184,50 @@ def enter_docx_file(filename):
     docx_string - user input, formatted as a string
     """
 
-    root = tk.Tk()
-    root.withdraw()
-    docx_string = tk.simpledialog.askstring(filename, f"Enter your {filename}:")
+    from tkinter import messagebox, simpledialog
+
+    docx_string = simpledialog.askstring(filename, f"Enter your {filename}:", parent=get_root())
     
     if docx_string:
-        # Cache the docx_string using pickle
-        with open(f"""{filename.replace(" ", "_")}.pkl""", "wb") as f:
-            pickle.dump(docx_string, f)
+        cache_file(filename, docx_string)
     else:
-        messagebox.showwarning(filename, f"No {filename} entered. No {filename} cached.")
+        messagebox.showwarning(filename, f"No {filename} entered. No {filename} cached.", parent=get_root())
         docx_string = get_cached_file(filename)
 
     return docx_string
 
 
+def get_cache_path(filename, extension=".json.zst"):
+    """
+    Locates the cached file for a type of user input
+
+    Input:
+    filename - string indexing the type of the file selected 
+    extension - file extension of the cache
+
+    Output:
+    path - path of the cached file
+    """
+
+    return f"""{filename.replace(" ", "_")}{extension}"""
+
+
+def cache_file(filename, docx_string):
+    """
+    Caches user input as a zstd compressed json file
+
+    Input:
+    filename - string indexing the type of the file selected 
+    docx_string - user input, formatted as a string
+    """
+
+    write_atomic(get_cache_path(filename), zstd.ZstdCompressor(level=3).compress(orjson.dumps(docx_string)))
+
+
 def get_cached_file(filename):
     """
-    Retrieves cached file stored in a pickle
+    Retrieves cached file stored in a zstd compressed json file, migrating 
+    caches written by older versions of CoverletterMe
 
     Input:
     filename - string indexing the type of the file selected 
@@ -123,10 +1238,45 @@ def get_cached_file(filename):
     """
 
     try:
-        with open(f"""{filename.replace(" ", "_")}.pkl""", "rb") as f:
-            docx_string = pickle.load(f)
-        return docx_string
-    except FileNotFoundError:
+        with open(get_cache_path(filename), "rb") as f:
+            return orjson.loads(zstd.ZstdDecompressor().decompress(f.read()))
+    except (FileNotFoundError, zstd.ZstdError, orjson.JSONDecodeError):
+        # A missing or unreadable cache falls back to older cache formats
+        pass
+
+    docx_string = get_legacy_cached_file(filename)
+    if docx_string is not None:
+        cache_file(filename, docx_string)
+
+    return docx_string
+
+
+def get_legacy_cached_file(filename):
+    """
+    Retrieves cached file stored by older versions of CoverletterMe, either
+    as an uncompressed json file or as a pickle
+
+    Input:
+    filename - string indexing the type of the file selected 
+
+    Output:
+    docx_string - content in the .docx file, formatted as a string. 
+                  or None if said file doesn't exist or can't be read
+    """
+
+    import pickle
+
+    try:
+        with open(get_cache_path(filename, ".json"), "rb") as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        pass
+
+    # Older versions didn't write the pickle atomically, it may be cut off
+    try:
+        with open(get_cache_path(filename, ".pkl"), "rb") as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
         return None
     
 
@@ -138,14 +1288,14 @@ def get_resume():
     resume - content in the resume file, formatted as string
     """
 
-    # Check if there is a pickled file for resume
+    from tkinter import messagebox
+
+    # Check if there is a cached file for resume
     resume = get_cached_file("Resume")
 
     if resume is not None:
         # Ask the user if they wish to use the existing resume
-        root = tk.Tk()
-        root.withdraw()
-        result = messagebox.askyesno("Resume", "Do you want to use the existing resume?")
+        result = messagebox.askyesno("Resume", "Do you want to use the existing resume?", parent=get_root())
 
         if not result:
             # Prompt the user to select a .docx file using GUI
@@ -164,15 +1314,14 @@ def get_coverletter():
     Output:
     cover_letter - content in the coverletter file, formatted as string
     """
-     
-    # Check if there is a pickled file for cover
+    from tkinter import messagebox
+
+    # Check if there is a cached file for cover
     cover_letter = get_cached_file("Cover Letter")
 
     if cover_letter is not None:
         # Ask the user if they wish to use the existing cover letter
-        root = tk.Tk()
-        root.withdraw()
-        result = messagebox.askyesno("Cover Letter", "Do you want to use the existing cover letter?")
+        result = messagebox.askyesno("Cover Letter", "Do you want to use the existing cover letter?", parent=get_root())
 
         if not result:
             # Prompt the user to select a .docx file using GUI
@@ -191,15 +1340,14 @@ def get_job_description():
     Output:
     description - content in user input, formatted as string
     """
-     
-    # Check if there is a pickled file for job description
+    from tkinter import messagebox
+
+    # Check if there is a cached file for job description
     description = get_cached_file("Job description")
 
     if description is not None:
         # Ask the user if they wish to use the existing job description
-        root = tk.Tk()
-        root.withdraw()
-        result = messagebox.askyesno("Job description", "Do you want to use the existing job description?")
+        result = messagebox.askyesno("Job description", "Do you want to use the existing job description?", parent=get_root())
 
         if not result:
             # Prompt the user to select a .docx file using GUI
@@ -218,15 +1366,14 @@ def get_remarks():
     Output:
     remarks - content in user input, formatted as string
     """
-     
-    # Check if there is a pickled file for additional prompt
+    from tkinter import messagebox
+
+    # Check if there is a cached file for additional prompt
     remarks = get_cached_file("Additional prompt")
 
     if remarks is not None:
         # Ask the user if they wish to use the existing remarks
-        root = tk.Tk()
-        root.withdraw()
-        result = messagebox.askyesno("Additional prompt", "Do you want to change existing additional prompt?")
+        result = messagebox.askyesno("Additional prompt", "Do you want to change existing additional prompt?", parent=get_root())
 
         if not result:
             # Prompt the user to select a .docx file using GUI
@@ -238,45 +1385,199 @@ def get_remarks():
     return remarks
 
 
-def get_prompt():
+def clean_text(text, max_chars=None):
     """
-    Helper function to generate ChatGPT prompt
+    Collapses whitespace in user input so the prompt doesn't carry boilerplate
+
+    Input:
+    text - user input formatted as string
+    max_chars - if given, only the last max_chars characters are kept
 
     Output:
-    prompt used to get ChatGPT generated coverletter
+    text - cleaned up user input
+    """
+
+    text = re.sub(r"\s+", " ", text or "").strip()
+    if max_chars is not None:
+        text = text[-max_chars:]
+
+    return text
+
+
+def get_documents():
+    """
+    Helper function to collect the documents used in the ChatGPT prompts
+
+    Output:
+    resume - content in the resume file, formatted as string
+    reference_coverletter - content in the coverletter file, formatted as string
+    """
+    resume = clean_text(get_resume())
+    # The end of the reference coverletter carries enough of its tone
+    reference_coverletter = clean_text(get_coverletter(), max_chars=1500)
+
+    return resume, reference_coverletter
+
+
+def get_job_inputs():
+    """
+    Helper function to collect the job specific input used in the ChatGPT prompts
+
+    Output:
+    description - job description, formatted as string
+    remarks - additional prompt, formatted as string
+    """
+    description = clean_text(get_job_description())
+    remarks = clean_text(get_remarks())
+
+    return description, remarks
+
+
+def get_batch_inputs():
+    """
+    Helper function to collect user input shared by every job of a batch run
+
+    Output:
+    resume - content in the resume file, formatted as string
+    reference_coverletter - content in the coverletter file, formatted as string
+    remarks - additional prompt, formatted as string
+    """
+    resume, reference_coverletter = get_documents()
+    remarks = clean_text(get_remarks())
+
+    return resume, reference_coverletter, remarks
+
+
+def read_batch_jobs(path):
+    """
+    Reads and checks the jobs of a batch run, problems are reported to the
+    user before any other dialog opens
+
+    Input:
+    path - path of a .jsonl file, each line holding a job with an "id", a 
+           "description" and optionally its own "remarks"
+
+    Output:
+    jobs - list of jobs, each formatted as a dictionary, 
+           or None if any job is invalid
+    """
+
+    from tkinter import messagebox
+
+    jobs, problems, line_numbers = [], [], {}
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                job = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                problems.append(f"Line {number}: not valid JSON")
+                continue
+
+            problem = get_batch_job_problem(job)
+            if problem is None and str(job["id"]) in line_numbers:
+                problem = f"id {job['id']!r} is already used on line {line_numbers[str(job['id'])]}"
+            if problem is not None:
+                problems.append(f"Line {number}: {problem}")
+                continue
+
+            line_numbers[str(job["id"])] = number
+            jobs.append(job)
+
+    if not jobs and not problems:
+        problems.append("No jobs found")
+
+    if problems:
+        messagebox.showwarning("CoverletterMe", f"{path} can't be used for a batch run:\n" + "\n".join(problems[:10]),
+                               parent=get_root())
+        return None
+
+    return jobs
+
+
+def get_batch_job_problem(job):
+    """
+    Checks a single job of a batch run
+
+    Input:
+    job - job read from a line of the .jsonl file
+
+    Output:
+    problem - what is wrong with the job, or None if it can be used
+    """
+
+    if not isinstance(job, dict):
+        return "not a JSON object"
+    if "id" not in job:
+        return "no \"id\""
+    # The id is used in the name of the coverletter file
+    if isinstance(job["id"], bool) or not isinstance(job["id"], (str, int)) \
+            or not re.fullmatch(r"[A-Za-z0-9_-][A-Za-z0-9._-]*", str(job["id"])):
+        return f"id {job['id']!r} may only hold letters, digits, \".\", \"_\" and \"-\""
+    if not isinstance(job.get("description"), str) or not job["description"].strip():
+        return "no \"description\""
+    if not isinstance(job.get("remarks", ""), str):
+        return "\"remarks\" is not a string"
+
+    return None
+
+
+def get_summary_prompts(resume, reference_coverletter, description):
+    """
+    Helper function to generate the ChatGPT prompts that summarize user input
+
+    Input:
+    resume - content in the resume file, formatted as string
+    reference_coverletter - content in the coverletter file, formatted as string
+    description - job description, formatted as string
+
+    Output:
+    prompts summarizing the job description, the resume and the reference 
+    coverletter, in that order
+    """
+    # A long job description is cut to fit the context of the summary model
+    description_prompt = DESCRIPTION_PROMPT.format(description=clean_text(description, max_chars=SUMMARY_INPUT_CHARS))
+
+    return (description_prompt, *get_document_prompts(resume, reference_coverletter))
+
+
+def get_document_prompts(resume, reference_coverletter):
     """
-    resume = get_resume()
-    reference_coverletter = get_coverletter()
-    description = get_job_description()
-    remarks = get_remarks()
-    prompt = f"""
-    Perform the following actions: 
-    1 - Summarize the requirements for the following job \
-    description delimited by triple backticks.
-    Job description: ```{description}```
+    Helper function to generate the ChatGPT prompts that summarize the documents
+
+    Input:
+    resume - content in the resume file, formatted as string
+    reference_coverletter - content in the coverletter file, formatted as string
 
-    2 - Extract skills and experience relevant to the job \
-    description from the resume delimited by triple backticks, \
-    extract skills and experiences from the job description.
-    Resume: ```{resume}```
+    Output:
+    prompts summarizing the resume and the reference coverletter, in that order
+    """
+    # A long resume is cut to fit the context of the summary model
+    resume_prompt = RESUME_PROMPT.format(resume=clean_text(resume, max_chars=SUMMARY_INPUT_CHARS))
+    reference_prompt = REFERENCE_PROMPT.format(reference_coverletter=reference_coverletter)
 
-    3 - Summarize relevant information from the following \
-    coverletter deliminated by triple backticks.
-    Reference coverletter: ```{reference_coverletter}```
+    return resume_prompt, reference_prompt
 
-    4 - Output a coverletter for the summarized job description in a \
-    professional and conversational tone. Format your response to be \
-    consistent with the reference cover letter.
 
-    The is intended for hiring manager, so it should focus on matching \
-    qualifications from the summarized resume and the cover letter to the \
-    job description provided. 
+def get_prompt(description_summary, resume_summary, reference_summary, remarks):
+    """
+    Helper function to generate ChatGPT prompt
 
-    Qualification should be presented using the "show, don't tell" technique. 
-        
-    Try to establish a relationship between my experiences and the job. 
+    Input:
+    description_summary - summarized job description
+    resume_summary - skills and experience extracted from the resume
+    reference_summary - summarized reference coverletter
+    remarks - additional prompt, formatted as string
 
-    Keep in mind that {remarks}.
+    Output:
+    prompt used to get ChatGPT generated coverletter
     """
+    prompt = COVERLETTER_PROMPT.format(
+        description_summary=description_summary,
+        resume_summary=resume_summary,
+        reference_summary=reference_summary,
+        remarks=remarks,
+    )
 
-    return prompt
\ No newline at end of file
+    return prompt